@@ -1,22 +1,25 @@
 """ClassPulse - FastAPI backend for live classroom theme extraction."""
 
 import asyncio
+import contextlib
+import hashlib
 import io
 import logging
 import os
 import secrets
 import time
-import uuid
+from collections import deque
 from contextlib import asynccontextmanager
 from datetime import datetime, timezone
 from pathlib import Path
-from typing import AsyncGenerator
+from typing import AsyncGenerator, NamedTuple
 
+import orjson
 import qrcode
 from dotenv import load_dotenv
 from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.responses import FileResponse, Response
 from fastapi.staticfiles import StaticFiles
 from sse_starlette.sse import EventSourceResponse
 
@@ -26,10 +29,14 @@ from models import (
     SessionInfoResponse,
     SubmitResponseRequest,
     SubmitResponseResponse,
-    SummaryPayload,
     Theme,
 )
-from openrouter import summarize_responses
+from openrouter import (
+    build_prompt_prefix,
+    create_client,
+    format_response_line,
+    summarize_responses,
+)
 
 load_dotenv()
 
@@ -40,105 +47,233 @@ logger = logging.getLogger(__name__)
 # In-memory store
 # ---------------------------------------------------------------------------
 
-sessions: dict[str, dict] = {}
-# sessions[session_id] = {
-#     "question": str,
-#     "admin_token": str,
-#     "responses": [{"id": str, "student_name": str, "answer": str, "ts": float}],
-#     "last_summary": SummaryPayload | None,
-#     "last_summarized_count": int,
-#     "sse_queues": list[asyncio.Queue],
-#     "created_at": float,
-#     "summarizer_task": asyncio.Task | None,
-# }
+class StudentResponse(NamedTuple):
+    """A single submitted answer, stored as a plain tuple."""
+
+    id: str
+    student_name: str
+    answer: str
+    ts: float
+
+
+class Session:
+    """State for one live question. Slotted to keep per-session memory small."""
+
+    __slots__ = (
+        "question",
+        "admin_token",
+        "responses",
+        "next_response_id",
+        "prompt_tail",
+        "prompt_text",
+        "last_summary_json",
+        "last_summarized_count",
+        "last_summarized_at",
+        "wake_event",
+        "sse_queues",
+        "sse_drops",
+        "created_at",
+        "summarizer_task",
+        "qr_png",
+        "qr_url",
+    )
+
+    def __init__(self, question: str, admin_token: str):
+        self.question = question
+        self.admin_token = admin_token
+        self.responses: deque[StudentResponse] = deque()
+        self.next_response_id = 0
+        # LLM prompt: question header plus one formatted line per response.
+        # prompt_tail only holds lines not yet merged into prompt_text.
+        self.prompt_tail: list[str] = []
+        self.prompt_text = build_prompt_prefix(question)
+        self.last_summary_json: str | None = None  # encoded SummaryPayload-shaped dict
+        self.last_summarized_count = 0
+        self.last_summarized_at = 0.0  # time.monotonic() of last summary
+        self.wake_event = asyncio.Event()  # set on each new response
+        self.sse_queues: set[asyncio.Queue] = set()
+        self.sse_drops: dict[asyncio.Queue, int] = {}
+        self.created_at = time.time()
+        self.summarizer_task: asyncio.Task | None = None
+        self.qr_png: bytes | None = None  # cached QR code for qr_url
+        self.qr_url: str | None = None
+
+
+sessions: dict[str, Session] = {}
 
 SESSION_EXPIRY_HOURS = 24
 MIN_RESPONSES_FOR_SUMMARY = 3
-SUMMARIZE_INTERVAL_SECONDS = 10
+SUMMARIZE_INTERVAL_SECONDS = 10  # minimum gap between summaries
+MIN_NEW_RESPONSES_FOR_RESUMMARY = 5
+MAX_RESUMMARY_INTERVAL_SECONDS = 60  # summarize stragglers at least this often
+SSE_QUEUE_MAXSIZE = 16
+SSE_MAX_CONSECUTIVE_DROPS = 3
+# Upper bound on concurrent OpenRouter requests across all sessions
+OPENROUTER_MAX_CONCURRENCY = int(os.environ.get("OPENROUTER_MAX_CONCURRENCY", "8"))
+if OPENROUTER_MAX_CONCURRENCY < 1:
+    raise ValueError(
+        f"OPENROUTER_MAX_CONCURRENCY must be at least 1, got {OPENROUTER_MAX_CONCURRENCY}"
+    )
 
 
 # ---------------------------------------------------------------------------
 # Background summarizer
 # ---------------------------------------------------------------------------
 
+def _close_stream(q: asyncio.Queue):
+    """Discard pending items and tell the SSE generator reading ``q`` to stop."""
+    while not q.empty():
+        q.get_nowait()
+    q.put_nowait(None)
+
+
+def _broadcast(session: Session, payload: str):
+    """Push a JSON-encoded summary to every SSE subscriber without blocking.
+
+    Queues are bounded; when a client falls behind, its oldest pending item is
+    dropped in favour of the newest (only the latest summary matters). A client
+    that keeps overflowing is disconnected via a ``None`` sentinel.
+    """
+    drops = session.sse_drops
+    for q in list(session.sse_queues):
+        try:
+            q.put_nowait(payload)
+            drops.pop(q, None)
+            continue
+        except asyncio.QueueFull:
+            pass
+
+        drops[q] = drops.get(q, 0) + 1
+        if drops[q] >= SSE_MAX_CONSECUTIVE_DROPS:
+            logger.warning("Disconnecting slow SSE client")
+            session.sse_queues.discard(q)
+            del drops[q]
+            _close_stream(q)
+            continue
+
+        q.get_nowait()
+        q.put_nowait(payload)
+
+
+def _prompt_text(session: Session) -> str:
+    """Return the full user prompt, merging in only the lines added since last call."""
+    tail = session.prompt_tail
+    if tail:
+        session.prompt_text = "\n".join([session.prompt_text, *tail])
+        tail.clear()
+    return session.prompt_text
+
+
 async def _summarizer_loop(session_id: str):
     """Background loop that auto-summarizes responses for a session."""
     logger.info("Summarizer started for session %s", session_id)
     while True:
-        await asyncio.sleep(SUMMARIZE_INTERVAL_SECONDS)
-
         session = sessions.get(session_id)
         if session is None:
             logger.info("Session %s removed, stopping summarizer", session_id)
             return
 
-        responses = session["responses"]
+        responses = session.responses
         count = len(responses)
-
-        if count < MIN_RESPONSES_FOR_SUMMARY:
-            continue
-
-        if count == session["last_summarized_count"]:
+        pending = count - session.last_summarized_count
+        since_last = time.monotonic() - session.last_summarized_at
+
+        if count < MIN_RESPONSES_FOR_SUMMARY or pending == 0:
+            due, timeout = False, None
+        else:
+            due = (
+                session.last_summarized_count == 0
+                or pending >= MIN_NEW_RESPONSES_FOR_RESUMMARY
+                or since_last >= MAX_RESUMMARY_INTERVAL_SECONDS
+            )
+            timeout = MAX_RESUMMARY_INTERVAL_SECONDS - since_last
+
+        if not due:
+            # Sleep until a new response arrives or the straggler deadline hits
+            wake_event = session.wake_event
+            wake_event.clear()
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(wake_event.wait(), timeout=timeout)
             continue
 
         logger.info(
             "Summarizing session %s (%d responses, last summarized at %d)",
-            session_id, count, session["last_summarized_count"],
+            session_id, count, session.last_summarized_count,
         )
 
         result = await summarize_responses(
-            question=session["question"],
-            responses=[
-                {"student_name": r["student_name"], "answer": r["answer"]}
-                for r in responses
-            ],
+            prompt_text=_prompt_text(session),
+            client=app.state.http,
+            limiter=app.state.openrouter_sem,
         )
 
         if result is None:
             logger.warning("Summarization failed for session %s, using raw response fallback", session_id)
             # Fallback: show each response as its own theme card
             fallback_themes = [
-                {
-                    "title": f"Response from {r['student_name']}",
-                    "description": r["answer"],
-                    "student_names": [r["student_name"]],
-                }
-                for r in responses
+                Theme(
+                    title=f"Response from {name}",
+                    description=answer,
+                    student_names=[name],
+                )
+                for _, name, answer, _ in responses
             ]
             result = {
                 "themes": fallback_themes,
                 "model_used": "Raw responses (AI unavailable)",
             }
 
-        summary = SummaryPayload(
-            themes=[Theme(**t) for t in result["themes"]],
-            response_count=count,
-            model_used=result.get("model_used"),
-            timestamp=datetime.now(timezone.utc).isoformat(),
-        )
+        # Same shape as SummaryPayload, built as a plain dict since it is only
+        # ever serialized, never returned through a response_model
+        summary = {
+            "themes": [t.model_dump() for t in result["themes"]],
+            "response_count": count,
+            "model_used": result.get("model_used"),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+        }
+
+        # Encode once for every current and future subscriber
+        session.last_summary_json = orjson.dumps(summary).decode()
+        session.last_summarized_count = count
+        session.last_summarized_at = time.monotonic()
 
-        session["last_summary"] = summary
-        session["last_summarized_count"] = count
+        if session.sse_queues:
+            _broadcast(session, session.last_summary_json)
 
-        payload = summary.model_dump()
-        for q in session["sse_queues"]:
-            await q.put(payload)
+        logger.info("Summary pushed for session %s (%d themes)", session_id, len(summary["themes"]))
 
-        logger.info("Summary pushed for session %s (%d themes)", session_id, len(summary.themes))
+        # Rate-limit upstream calls even under a steady stream of responses
+        await asyncio.sleep(SUMMARIZE_INTERVAL_SECONDS)
 
 
 def _ensure_summarizer(session_id: str):
     """Start the summarizer background task if not already running."""
     session = sessions[session_id]
-    task = session.get("summarizer_task")
+    task = session.summarizer_task
     if task is None or task.done():
-        session["summarizer_task"] = asyncio.create_task(_summarizer_loop(session_id))
+        session.summarizer_task = asyncio.create_task(_summarizer_loop(session_id))
 
 
 # ---------------------------------------------------------------------------
 # Cleanup old sessions
 # ---------------------------------------------------------------------------
 
+async def _expire_session(session_id: str):
+    """Remove a session, stop its summarizer and close its SSE streams."""
+    session = sessions.pop(session_id, None)
+    if session is None:
+        return
+    task = session.summarizer_task
+    if task and not task.done():
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+    for q in session.sse_queues:
+        _close_stream(q)
+    session.sse_queues.clear()
+    logger.info("Cleaned up expired session %s", session_id)
+
+
 async def _cleanup_loop():
     """Periodically remove expired sessions."""
     while True:
@@ -146,14 +281,14 @@ async def _cleanup_loop():
         now = time.time()
         expired = [
             sid for sid, s in sessions.items()
-            if now - s["created_at"] > SESSION_EXPIRY_HOURS * 3600
+            if now - s.created_at > SESSION_EXPIRY_HOURS * 3600
         ]
-        for sid in expired:
-            task = sessions[sid].get("summarizer_task")
-            if task and not task.done():
-                task.cancel()
-            del sessions[sid]
-            logger.info("Cleaned up expired session %s", sid)
+        results = await asyncio.gather(
+            *(_expire_session(sid) for sid in expired), return_exceptions=True,
+        )
+        for sid, result in zip(expired, results):
+            if isinstance(result, Exception):
+                logger.error("Failed to expire session %s", sid, exc_info=result)
 
 
 # ---------------------------------------------------------------------------
@@ -162,14 +297,21 @@ async def _cleanup_loop():
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    app.state.http = create_client()
+    app.state.openrouter_sem = asyncio.Semaphore(OPENROUTER_MAX_CONCURRENCY)
     cleanup_task = asyncio.create_task(_cleanup_loop())
     yield
-    cleanup_task.cancel()
-    # Cancel all summarizer tasks
+    # Cancel all background tasks and let them unwind before closing the
+    # shared client they may still be using
+    tasks = [cleanup_task]
     for s in sessions.values():
-        task = s.get("summarizer_task")
+        task = s.summarizer_task
         if task and not task.done():
-            task.cancel()
+            tasks.append(task)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await app.state.http.aclose()
 
 
 app = FastAPI(title="ClassPulse API", version="1.0.0", lifespan=lifespan)
@@ -196,21 +338,12 @@ async def health():
 
 @app.post("/api/sessions", response_model=CreateSessionResponse)
 async def create_session(req: CreateSessionRequest, request: Request):
-    session_id = str(uuid.uuid4())[:8]
+    session_id = secrets.token_hex(6)
     admin_token = secrets.token_urlsafe(16)
 
     base_url = str(request.base_url).rstrip("/")
 
-    sessions[session_id] = {
-        "question": req.question,
-        "admin_token": admin_token,
-        "responses": [],
-        "last_summary": None,
-        "last_summarized_count": 0,
-        "sse_queues": [],
-        "created_at": time.time(),
-        "summarizer_task": None,
-    }
+    sessions[session_id] = Session(req.question, admin_token)
 
     student_url = f"{base_url}/session/{session_id}"
     admin_url = f"{base_url}/session/{session_id}/admin?token={admin_token}"
@@ -231,8 +364,8 @@ async def get_session(session_id: str):
         raise HTTPException(status_code=404, detail="Session not found")
     return SessionInfoResponse(
         session_id=session_id,
-        question=session["question"],
-        response_count=len(session["responses"]),
+        question=session.question,
+        response_count=len(session.responses),
     )
 
 
@@ -242,21 +375,24 @@ async def submit_response(session_id: str, req: SubmitResponseRequest):
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
 
-    response_id = str(uuid.uuid4())[:8]
-    session["responses"].append({
-        "id": response_id,
-        "student_name": req.student_name,
-        "answer": req.answer,
-        "ts": time.time(),
-    })
+    # Single-threaded event loop: no lock needed around the counter
+    response_id = f"r{session.next_response_id}"
+    session.next_response_id += 1
+    session.responses.append(
+        StudentResponse(response_id, req.student_name, req.answer, time.time())
+    )
+    session.prompt_tail.append(
+        format_response_line(len(session.responses), req.student_name, req.answer)
+    )
+    session.wake_event.set()
 
     # Start summarizer if enough responses
-    if len(session["responses"]) >= MIN_RESPONSES_FOR_SUMMARY:
+    if len(session.responses) >= MIN_RESPONSES_FOR_SUMMARY:
         _ensure_summarizer(session_id)
 
     logger.info(
         "Response added to session %s by %s (total: %d)",
-        session_id, req.student_name, len(session["responses"]),
+        session_id, req.student_name, len(session.responses),
     )
     return SubmitResponseResponse(
         message="Thank you for your response!",
@@ -267,63 +403,70 @@ async def submit_response(session_id: str, req: SubmitResponseRequest):
 @app.get("/api/sessions/{session_id}/stream")
 async def stream_summary(
     session_id: str,
-    request: Request,
     admin_token: str = Query(...),
 ):
     session = sessions.get(session_id)
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
-    if session["admin_token"] != admin_token:
+    if session.admin_token != admin_token:
         raise HTTPException(status_code=403, detail="Invalid admin token")
 
-    queue: asyncio.Queue = asyncio.Queue()
-    session["sse_queues"].append(queue)
+    # Items are JSON-encoded summary strings, or None to close the stream
+    queue: asyncio.Queue[str | None] = asyncio.Queue(maxsize=SSE_QUEUE_MAXSIZE)
+    session.sse_queues.add(queue)
 
     async def event_generator() -> AsyncGenerator:
-        import json
         try:
             # Send the last summary immediately if available
-            if session["last_summary"] is not None:
-                yield {
-                    "event": "summary",
-                    "data": json.dumps(session["last_summary"].model_dump()),
-                }
+            if session.last_summary_json is not None:
+                yield {"event": "summary", "data": session.last_summary_json}
 
             # Send response count heartbeat
             yield {
                 "event": "status",
-                "data": json.dumps({
-                    "response_count": len(session["responses"]),
+                "data": orjson.dumps({
+                    "response_count": len(session.responses),
                     "min_required": MIN_RESPONSES_FOR_SUMMARY,
-                }),
+                }).decode(),
             }
 
+            # No is_disconnected() polling here: EventSourceResponse already
+            # watches the receive channel and cancels this generator on disconnect.
             while True:
-                if await request.is_disconnected():
-                    break
-
                 try:
                     payload = await asyncio.wait_for(queue.get(), timeout=5.0)
-                    if "error" in payload:
-                        yield {"event": "error", "data": json.dumps(payload)}
-                    else:
-                        yield {"event": "summary", "data": json.dumps(payload)}
+                    if payload is None:
+                        break
+                    # Summaries are encoded once by the summarizer for all streams
+                    yield {"event": "summary", "data": payload}
                 except asyncio.TimeoutError:
                     # Send periodic heartbeat with response count
                     yield {
                         "event": "status",
-                        "data": json.dumps({
-                            "response_count": len(session["responses"]),
+                        "data": orjson.dumps({
+                            "response_count": len(session.responses),
                             "min_required": MIN_RESPONSES_FOR_SUMMARY,
-                        }),
+                        }).decode(),
                     }
         finally:
-            if queue in session["sse_queues"]:
-                session["sse_queues"].remove(queue)
+            session.sse_queues.discard(queue)
+            session.sse_drops.pop(queue, None)
 
     return EventSourceResponse(event_generator())
 
 
+def _render_qr_png(data: str) -> bytes:
+    """Render a QR code as PNG bytes. CPU-bound; run it off the event loop."""
+    qr = qrcode.QRCode(version=1, box_size=10, border=4)
+    qr.add_data(data)
+    qr.make(fit=True)
+    img = qr.make_image(fill_color="black", back_color="white")
+
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+
 @app.get("/api/sessions/{session_id}/qr")
 async def get_qr_code(session_id: str, request: Request):
     session = sessions.get(session_id)
@@ -333,16 +476,22 @@ async def get_qr_code(session_id: str, request: Request):
     base_url = str(request.base_url).rstrip("/")
     student_url = f"{base_url}/session/{session_id}"
 
-    qr = qrcode.QRCode(version=1, box_size=10, border=4)
-    qr.add_data(student_url)
-    qr.make(fit=True)
-    img = qr.make_image(fill_color="black", back_color="white")
+    # The image encodes the request host, so key both the ETag and shared caches on it
+    etag = f'"{hashlib.sha256(student_url.encode()).hexdigest()[:16]}"'
+    headers = {
+        "Cache-Control": "public, max-age=86400, immutable",
+        "ETag": etag,
+        "Vary": "Host",
+    }
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
 
-    buf = io.BytesIO()
-    img.save(buf, format="PNG")
-    buf.seek(0)
+    # The student URL never changes for a session, so render the PNG once
+    if session.qr_png is None or session.qr_url != student_url:
+        session.qr_png = await asyncio.to_thread(_render_qr_png, student_url)
+        session.qr_url = student_url
 
-    return StreamingResponse(buf, media_type="image/png")
+    return Response(content=session.qr_png, media_type="image/png", headers=headers)
 
 
 # ---------------------------------------------------------------------------
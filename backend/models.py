@@ -1,6 +1,6 @@
 """Pydantic models for ClassPulse API."""
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, field_validator
 from typing import Optional
 
 
@@ -34,7 +34,21 @@ class SubmitResponseResponse(BaseModel):
 class Theme(BaseModel):
     title: str
     description: str
-    student_names: list[str]
+    student_names: list[str] = []
+
+    # LLM output is loosely typed: stringify scalar fields and drop non-string
+    # names rather than rejecting the whole theme
+    @field_validator("title", "description", mode="before")
+    @classmethod
+    def _coerce_to_str(cls, v):
+        return v if isinstance(v, str) else str(v)
+
+    @field_validator("student_names", mode="before")
+    @classmethod
+    def _keep_string_names(cls, v):
+        if not isinstance(v, (list, tuple)):
+            return []
+        return [n for n in v if isinstance(n, str)]
 
 
 class SummaryPayload(BaseModel):
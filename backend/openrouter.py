@@ -1,17 +1,35 @@
 """OpenRouter client with fallback chain across multiple cheap models."""
 
+import asyncio
+import contextlib
 import json
 import logging
 import re
 import os
-from typing import Optional
+from typing import Iterable, Optional
 
 import httpx
+from pydantic import TypeAdapter, ValidationError
+
+from models import Theme
 
 logger = logging.getLogger(__name__)
 
 OPENROUTER_API_URL = "https://openrouter.ai/api/v1/chat/completions"
 
+REQUEST_TIMEOUT = httpx.Timeout(20.0, connect=5.0)
+CONNECTION_LIMITS = httpx.Limits(max_keepalive_connections=32, max_connections=64)
+
+# Start a backup model if the current one hasn't answered within this delay
+HEDGE_DELAY_SECONDS = 3.0
+MAX_CONCURRENT_MODELS = 2
+
+THEMES_ADAPTER = TypeAdapter(list[Theme])
+
+# Markdown code fences some models wrap their JSON in
+_FENCE_START_RE = re.compile(r"^```(?:json)?\s*")
+_FENCE_END_RE = re.compile(r"\s*```$")
+
 FALLBACK_MODELS = [
     "google/gemini-2.0-flash-001",
     "meta-llama/llama-3.1-8b-instruct",
@@ -37,21 +55,71 @@ Response format:
 {"themes": [{"title": "...", "description": "...", "student_names": ["..."]}, ...]}"""
 
 
-def _build_user_prompt(question: str, responses: list[dict]) -> str:
-    """Build the user prompt from question and student responses."""
-    lines = [f'Question asked: "{question}"\n', "Student responses:"]
-    for i, r in enumerate(responses, 1):
-        lines.append(f'{i}. {r["student_name"]}: "{r["answer"]}"')
+def create_client() -> httpx.AsyncClient:
+    """Create a pooled HTTP/2 client for OpenRouter, meant to live for the app's lifetime."""
+    return httpx.AsyncClient(http2=True, timeout=REQUEST_TIMEOUT, limits=CONNECTION_LIMITS)
+
+
+def build_prompt_prefix(question: str) -> str:
+    """Build the fixed head of the user prompt for a question."""
+    return f'Question asked: "{question}"\n\nStudent responses:'
+
+
+def format_response_line(index: int, student_name: str, answer: str) -> str:
+    """Format a single numbered student response for the user prompt."""
+    return f'{index}. {student_name}: "{answer}"'
+
+
+def _build_user_prompt(question: str, responses: Iterable[tuple[str, str]]) -> str:
+    """Build the user prompt from question and (student_name, answer) pairs."""
+    lines = [build_prompt_prefix(question)]
+    for i, (name, answer) in enumerate(responses, 1):
+        lines.append(format_response_line(i, name, answer))
     return "\n".join(lines)
 
 
+def _iter_balanced(text: str, open_ch: str, close_ch: str):
+    """Yield the outermost balanced ``open_ch ... close_ch`` slices of text, in order.
+
+    Single linear pass with a stack of open positions. Brackets inside JSON
+    string literals are ignored, and openers that never close are simply left
+    on the stack, so a stray bracket before the real JSON does not hide it.
+    """
+    starts: list[int] = []
+    spans: list[tuple[int, int]] = []
+    in_string = False
+    escaped = False
+    for i, ch in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            # Quotes only matter inside a candidate; prose before it is ignored
+            in_string = bool(starts)
+        elif ch == open_ch:
+            starts.append(i)
+        elif ch == close_ch and starts:
+            start = starts.pop()
+            # This span encloses any spans closed since it opened
+            while spans and spans[-1][0] > start:
+                spans.pop()
+            spans.append((start, i))
+
+    for start, end in spans:
+        yield text[start:end + 1]
+
+
 def _parse_themes_json(text: str) -> Optional[dict]:
-    """Try to parse themes from LLM response text. Falls back to regex extraction."""
+    """Try to parse themes from LLM response text. Falls back to scanning for embedded JSON."""
     # Strip markdown code fences if present
     cleaned = text.strip()
     if cleaned.startswith("```"):
-        cleaned = re.sub(r"^```(?:json)?\s*", "", cleaned)
-        cleaned = re.sub(r"\s*```$", "", cleaned)
+        cleaned = _FENCE_START_RE.sub("", cleaned)
+        cleaned = _FENCE_END_RE.sub("", cleaned)
     cleaned = cleaned.strip()
 
     # Attempt 1: direct JSON parse
@@ -59,48 +127,94 @@ def _parse_themes_json(text: str) -> Optional[dict]:
         data = json.loads(cleaned)
         if "themes" in data and isinstance(data["themes"], list):
             return data
-    except json.JSONDecodeError:
+    except (json.JSONDecodeError, RecursionError):
         pass
 
-    # Attempt 2: find JSON object with regex
-    match = re.search(r"\{[\s\S]*\"themes\"\s*:\s*\[[\s\S]*\]\s*\}", cleaned)
-    if match:
+    # Attempt 2: find a balanced JSON object containing "themes"
+    for candidate in _iter_balanced(cleaned, "{", "}"):
         try:
-            data = json.loads(match.group(0))
-            if "themes" in data and isinstance(data["themes"], list):
+            data = json.loads(candidate)
+            if isinstance(data, dict) and isinstance(data.get("themes"), list):
                 return data
-        except json.JSONDecodeError:
+        except (json.JSONDecodeError, RecursionError):
             pass
 
     # Attempt 3: try to find array of themes directly
-    match = re.search(r"\[[\s\S]*\]", cleaned)
-    if match:
+    for candidate in _iter_balanced(cleaned, "[", "]"):
         try:
-            arr = json.loads(match.group(0))
-            if isinstance(arr, list) and len(arr) > 0 and "title" in arr[0]:
+            arr = json.loads(candidate)
+            if (
+                isinstance(arr, list) and len(arr) > 0
+                and isinstance(arr[0], dict) and "title" in arr[0]
+            ):
                 return {"themes": arr}
-        except json.JSONDecodeError:
+        except (json.JSONDecodeError, RecursionError):
             pass
 
     logger.warning("Failed to parse themes from LLM response: %s", text[:200])
     return None
 
 
+def _validate_themes(raw: object) -> list[Theme]:
+    """Validate LLM themes in one pass, salvaging the well-formed ones on error."""
+    try:
+        return THEMES_ADAPTER.validate_python(raw)
+    except ValidationError:
+        pass
+
+    valid_themes = []
+    for t in raw if isinstance(raw, list) else []:
+        try:
+            valid_themes.append(Theme.model_validate(t))
+        except ValidationError:
+            continue
+    return valid_themes
+
+
 async def summarize_responses(
-    question: str,
-    responses: list[dict],
+    question: str = "",
+    responses: Optional[Iterable[tuple[str, str]]] = None,
     api_key: Optional[str] = None,
+    prompt_text: Optional[str] = None,
+    client: Optional[httpx.AsyncClient] = None,
+    limiter: Optional[asyncio.Semaphore] = None,
 ) -> Optional[dict]:
     """Call OpenRouter with fallback chain to summarize student responses.
 
-    Returns dict with 'themes' list and 'model_used', or None if all models fail.
+    Pass either ``question`` and ``responses`` (any iterable of
+    ``(student_name, answer)`` pairs, walked once), or a ready-made ``prompt_text``
+    (e.g. one built incrementally by the caller) to skip prompt construction.
+    Pass a long-lived ``client`` to reuse pooled connections across calls;
+    otherwise a temporary one is opened for this call. A shared ``limiter``
+    bounds how many OpenRouter requests are in flight across all callers.
+
+    Returns dict with 'themes' (list of Theme) and 'model_used', or None if all
+    models fail. Raises ValueError if neither ``responses`` nor ``prompt_text``
+    is given.
     """
+    if prompt_text is None and responses is None:
+        raise ValueError("summarize_responses needs either responses or prompt_text")
+
     api_key = (api_key or os.environ.get("OPENROUTER_API_KEY", "")).strip()
     if not api_key:
         logger.error("OPENROUTER_API_KEY not set")
         return None
 
-    user_prompt = _build_user_prompt(question, responses)
+    if client is None:
+        async with httpx.AsyncClient(timeout=REQUEST_TIMEOUT) as client:
+            return await summarize_responses(
+                question=question,
+                responses=responses,
+                api_key=api_key,
+                prompt_text=prompt_text,
+                client=client,
+                limiter=limiter,
+            )
+
+    if prompt_text is not None:
+        user_prompt = prompt_text
+    else:
+        user_prompt = _build_user_prompt(question, responses)
 
     headers = {
         "Authorization": f"Bearer {api_key}",
@@ -109,75 +223,147 @@ async def summarize_responses(
         "X-Title": "ClassPulse",
     }
 
-    for model_id in FALLBACK_MODELS:
-        try:
-            logger.info("Trying model: %s", model_id)
-            payload = {
-                "model": model_id,
-                "messages": [
-                    {"role": "system", "content": SYSTEM_PROMPT},
-                    {"role": "user", "content": user_prompt},
-                ],
-                "temperature": 0.3,
-                "max_tokens": 2000,
-            }
-
-            async with httpx.AsyncClient(timeout=20.0) as client:
-                resp = await client.post(
-                    OPENROUTER_API_URL,
-                    headers=headers,
-                    json=payload,
-                )
-
-            if resp.status_code != 200:
-                logger.warning(
-                    "Model %s returned status %d: %s",
-                    model_id, resp.status_code, resp.text[:200],
-                )
-                continue
-
-            data = resp.json()
-            content = data.get("choices", [{}])[0].get("message", {}).get("content", "")
-
-            if not content:
-                logger.warning("Model %s returned empty content", model_id)
-                continue
-
-            parsed = _parse_themes_json(content)
-            if parsed is None:
-                logger.warning("Model %s returned unparseable content", model_id)
-                continue
-
-            # Validate themes structure
-            themes = parsed.get("themes", [])
-            valid_themes = []
-            for t in themes:
-                if isinstance(t, dict) and "title" in t and "description" in t:
-                    valid_themes.append({
-                        "title": str(t.get("title", "")),
-                        "description": str(t.get("description", "")),
-                        "student_names": [
-                            str(n) for n in t.get("student_names", [])
-                            if isinstance(n, str)
-                        ],
-                    })
-
-            if len(valid_themes) < 2:
-                logger.warning("Model %s returned too few valid themes: %d", model_id, len(valid_themes))
-                continue
-
-            logger.info("Successfully used model: %s (%d themes)", model_id, len(valid_themes))
-            return {
-                "themes": valid_themes,
-                "model_used": model_id,
-            }
-
-        except httpx.TimeoutException:
-            logger.warning("Model %s timed out", model_id)
-            continue
-        except Exception as e:
-            logger.warning("Model %s failed with error: %s", model_id, str(e))
-            continue
+    return await _race_models(client, headers, user_prompt, limiter)
+
+
+async def _race_models(
+    client: httpx.AsyncClient,
+    headers: dict,
+    user_prompt: str,
+    limiter: Optional[asyncio.Semaphore] = None,
+) -> Optional[dict]:
+    """Walk the fallback chain, hedging slow or failed models with the next one.
+
+    Once the primary model holds a limiter slot it runs alone for
+    HEDGE_DELAY_SECONDS; if it has not answered by then, the next model is
+    started alongside it (at most MAX_CONCURRENT_MODELS at a time). Time spent
+    queued on the limiter does not count, so a saturated limiter never triggers
+    hedges. A failed attempt is replaced right away. The first valid result
+    wins and the remaining requests are cancelled.
+    """
+    models = iter(FALLBACK_MODELS)
+    pending: set[asyncio.Task] = set()
+    slots: dict[asyncio.Task, asyncio.Event] = {}
+    latest: Optional[asyncio.Task] = None
+
+    def launch_next():
+        nonlocal latest
+        model_id = next(models, None)
+        if model_id is not None:
+            slot = asyncio.Event()
+            latest = asyncio.create_task(
+                _try_model(client, model_id, headers, user_prompt, limiter, slot)
+            )
+            slots[latest] = slot
+            pending.add(latest)
+
+    launch_next()
+    try:
+        while pending:
+            timeout = None
+            if len(pending) < MAX_CONCURRENT_MODELS:
+                if latest in pending and not slots[latest].is_set():
+                    # Start the hedge clock only once the newest attempt holds a slot
+                    slot_waiter = asyncio.create_task(slots[latest].wait())
+                    try:
+                        await asyncio.wait(
+                            {*pending, slot_waiter}, return_when=asyncio.FIRST_COMPLETED,
+                        )
+                    finally:
+                        slot_waiter.cancel()
+                    if not any(task.done() for task in pending):
+                        continue
+                timeout = HEDGE_DELAY_SECONDS
+
+            done, pending = await asyncio.wait(
+                pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED,
+            )
+            for task in done:
+                result = task.result()
+                if result is not None:
+                    return result
+
+            if done:
+                for _ in done:
+                    launch_next()
+            elif len(pending) < MAX_CONCURRENT_MODELS:
+                launch_next()
+    finally:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
 
     logger.error("All models failed to produce a valid summary")
     return None
+
+
+async def _try_model(
+    client: httpx.AsyncClient,
+    model_id: str,
+    headers: dict,
+    user_prompt: str,
+    limiter: Optional[asyncio.Semaphore] = None,
+    slot: Optional[asyncio.Event] = None,
+) -> Optional[dict]:
+    """Ask a single model for themes. Returns None on any failure.
+
+    ``slot`` is set once the request holds a limiter slot and is about to be sent.
+    """
+    try:
+        logger.info("Trying model: %s", model_id)
+        payload = {
+            "model": model_id,
+            "messages": [
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": user_prompt},
+            ],
+            "temperature": 0.3,
+            "max_tokens": 2000,
+        }
+
+        async with limiter or contextlib.nullcontext():
+            if slot is not None:
+                slot.set()
+            resp = await client.post(
+                OPENROUTER_API_URL,
+                headers=headers,
+                json=payload,
+            )
+
+        if resp.status_code != 200:
+            logger.warning(
+                "Model %s returned status %d: %s",
+                model_id, resp.status_code, resp.text[:200],
+            )
+            return None
+
+        data = resp.json()
+        content = data.get("choices", [{}])[0].get("message", {}).get("content", "")
+
+        if not content:
+            logger.warning("Model %s returned empty content", model_id)
+            return None
+
+        parsed = _parse_themes_json(content)
+        if parsed is None:
+            logger.warning("Model %s returned unparseable content", model_id)
+            return None
+
+        valid_themes = _validate_themes(parsed.get("themes", []))
+
+        if len(valid_themes) < 2:
+            logger.warning("Model %s returned too few valid themes: %d", model_id, len(valid_themes))
+            return None
+
+        logger.info("Successfully used model: %s (%d themes)", model_id, len(valid_themes))
+        return {
+            "themes": valid_themes,
+            "model_used": model_id,
+        }
+
+    except httpx.TimeoutException:
+        logger.warning("Model %s timed out", model_id)
+        return None
+    except Exception as e:
+        logger.warning("Model %s failed with error: %s", model_id, str(e))
+        return None